@@ -7,46 +7,149 @@
 # Optional:
 #   - ffd_logs.csv
 #   - incidents.csv
+# Each input may also be shipped as <name>.parquet, which is preferred over
+# the CSV. One-time conversion (typed, projected to CLEAN_COLS below):
+#   pd.read_csv("olist_clean_with_features.csv", usecols=CLEAN_COLS,
+#               parse_dates=["order_purchase_timestamp","order_estimated_delivery_date"]
+#   ).to_parquet("olist_clean_with_features.parquet", compression="zstd")
 # Run: streamlit run app.py
 
 import os
+import hashlib
+import threading
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import altair as alt
 import streamlit as st
 from datetime import timedelta
 
+from numba import njit
+
 st.set_page_config(page_title="Olist Decision Dashboard", layout="wide")
 
 # ---------- Helpers ----------
+# only the order-level fields the dashboard actually reads
+CLEAN_COLS = ["order_id","order_purchase_timestamp","on_time","delivery_time_days",
+              "review_score_mean","gross_revenue","order_estimated_delivery_date"]
+CACHE_DIR = ".cache"
+
 def read_csv_safe(path, **kw):
     if os.path.exists(path):
         return pd.read_csv(path, **kw)
     return None
 
+def _load_table(base, columns=None, parse_dates=None):
+    # Parquet is typed and memory-mapped; the CSV is only a fallback
+    if os.path.exists(base + ".parquet"):
+        df = pq.read_table(base + ".parquet", columns=columns, memory_map=True).to_pandas()
+        # files converted without parse_dates store timestamps as strings
+        for c in parse_dates or []:
+            if not pd.api.types.is_datetime64_any_dtype(df[c]):
+                df[c] = pd.to_datetime(df[c])
+        return df
+    return read_csv_safe(base + ".csv", usecols=columns, parse_dates=parse_dates, engine="pyarrow")
+
+def _load_cached(name, base, **kw):
+    # reuse .cache/olist_<name>_<args>.feather while it is newer than the source file;
+    # the load arguments are part of the name so a changed projection never reads a stale schema
+    src = next((base + ext for ext in (".parquet", ".csv") if os.path.exists(base + ext)), None)
+    if src is None:
+        return None
+    key = hashlib.md5(repr(sorted(kw.items())).encode(), usedforsecurity=False).hexdigest()[:8]
+    sidecar = os.path.join(CACHE_DIR, f"olist_{name}_{key}.feather")
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) > os.path.getmtime(src):
+        try:
+            return pd.read_feather(sidecar)
+        except (OSError, pa.ArrowException):
+            pass  # truncated or corrupt sidecar: reparse the source and rewrite it
+    df = _load_table(base, **kw)
+    # write beside the target under a per-writer name and rename, so readers never see a partial file
+    tmp = f"{sidecar}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_feather(tmp, compression="lz4")
+        os.replace(tmp, sidecar)
+    except (OSError, pa.ArrowException):
+        # read-only checkout or unwritable frame: keep serving from the parsed frame
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return df
+
+def _p90(values):
+    # np.nanpercentile(values, 90) via an O(N) partition instead of a full sort
+    arr = values[~np.isnan(values)]
+    if not arr.size:
+        return np.nan
+    pos = 0.9 * (arr.size - 1)
+    k = int(pos)
+    k1 = min(k + 1, arr.size - 1)
+    part = np.partition(arr, [k, k1])
+    return part[k] + (part[k1] - part[k]) * (pos - k)
+
+@st.cache_resource
+def _arrow(df):
+    # st.dataframe takes Arrow tables as-is, so the pandas->Arrow step runs once per table
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+@st.cache_resource
+def _impact_kernel():
+    # one pass over the (segment x scenario) rows; serial on purpose, since
+    # numba's parallel backends misbehave when called from Streamlit's script threads
+    @njit(cache=True)
+    def kernel(gmv, uplift, take_rate, orders, cost_per_order, out):
+        for i in range(len(gmv)):
+            incr = gmv[i] * uplift[i] * 0.01
+            plat = incr * take_rate[i]
+            cost = orders[i] * cost_per_order[i]
+            out[i, 0] = incr
+            out[i, 1] = plat
+            out[i, 2] = cost
+            out[i, 3] = plat - cost
+    kernel(*(np.zeros(1),)*5, np.empty((1, 4)))  # size-1 call triggers the compile
+    return kernel
+
+# precompile at import; st.cache_resource keeps later reruns from rebuilding it
+_impact_kernel()
+
+@st.cache_resource
+def _raw_tables():
+    clean = _load_cached("clean", "olist_clean_with_features", columns=CLEAN_COLS, parse_dates=[
+        "order_purchase_timestamp","order_estimated_delivery_date"
+    ])
+    seg = _load_cached("seg", "segments_summary")
+    impact = _load_cached("impact", "impact_models")
+    ffd = _load_cached("ffd", "ffd_logs", parse_dates=["timestamp"])
+    inc = _load_cached("inc", "incidents", parse_dates=["opened_at"])
+    return clean, seg, impact, ffd, inc
+
 @st.cache_data
 def load_data():
-    clean = read_csv_safe("olist_clean_with_features.csv", parse_dates=[
-        "order_purchase_timestamp","order_delivered_customer_date","order_estimated_delivery_date"
-    ])
-    seg = read_csv_safe("segments_summary.csv")
-    impact = read_csv_safe("impact_models.csv")
-    ffd = read_csv_safe("ffd_logs.csv", parse_dates=["timestamp"])
-    inc = read_csv_safe("incidents.csv", parse_dates=["opened_at"])
+    clean, seg, impact, ffd, inc = _raw_tables()
 
-    # demo fallbacks
+    # demo fallbacks (seeded, so reruns and cache keys stay stable)
+    rng = np.random.default_rng(0)
     if clean is None:
         st.warning("olist_clean_with_features.csv not found — using demo frame")
         dates = pd.date_range("2017-01-01", periods=400, freq="D")
         clean = pd.DataFrame({
             "order_id": np.arange(1,5001),
-            "order_purchase_timestamp": np.random.choice(dates, 5000),
-            "on_time": np.random.choice([1,1,1,0], 5000, p=[0.93,0.03,0.02,0.02]),
-            "delivery_time_days": np.random.gamma(4.5, 2.2, 5000),
-            "review_score_mean": np.random.choice([5,4,3,2,1],[5000],p=[0.5,0.25,0.15,0.07,0.03]),
-            "gross_revenue": np.random.gamma(3, 50, 5000),
+            "order_purchase_timestamp": rng.choice(dates.values, 5000),
+            "on_time": rng.choice([1,1,1,0], 5000, p=[0.93,0.03,0.02,0.02]),
+            "delivery_time_days": rng.gamma(4.5, 2.2, 5000),
+            "review_score_mean": rng.choice([5,4,3,2,1], 5000, p=[0.5,0.25,0.15,0.07,0.03]),
+            "gross_revenue": rng.gamma(3, 50, 5000),
         })
-        clean["order_estimated_delivery_date"] = clean["order_purchase_timestamp"] + pd.to_timedelta(np.random.randint(5,12,5000), unit="D")
+        clean["order_estimated_delivery_date"] = clean["order_purchase_timestamp"].values + rng.integers(5,12,5000).astype("timedelta64[D]")
+    # narrow numeric columns; skip non-numeric ids and ints that would lose NaNs
+    narrow = {"on_time":"int8","order_id":"int32","review_score_mean":"float32",
+              "delivery_time_days":"float32","gross_revenue":"float32"}
+    clean = clean.astype({c: t for c, t in narrow.items()
+                          if c in clean and pd.api.types.is_numeric_dtype(clean[c])
+                          and not (t.startswith("int") and clean[c].isna().any())})
+    # sorted once so time windows can be sliced by binary search
+    clean = clean.sort_values("order_purchase_timestamp", kind="stable", ignore_index=True)
 
     if seg is None:
         st.warning("segments_summary.csv not found — using demo segments")
@@ -78,13 +181,11 @@ def load_data():
             "خالص اثر بر پلتفرم":0
         })
         # compute base numbers
-        def recalc(row):
-            incr = row["GMV پایه (۹۰ روز)"] * (row["uplift_gmv_%"]/100)
-            plat = incr * row["take_rate"]
-            cost = row["سفارش‌ها (۹۰ روز)"] * row["cost_per_order"]
-            net  = plat - cost
-            return pd.Series({"افزایش GMV (۹۰ روز)":incr,"سهم پلتفرم از افزایش GMV":plat,"هزینه کل":cost,"خالص اثر بر پلتفرم":net})
-        impact[["افزایش GMV (۹۰ روز)","سهم پلتفرم از افزایش GMV","هزینه کل","خالص اثر بر پلتفرم"]] = impact.apply(recalc, axis=1)
+        out = np.empty((len(impact), 4))
+        _impact_kernel()(*(impact[c].to_numpy(dtype="float64") for c in [
+            "GMV پایه (۹۰ روز)","uplift_gmv_%","take_rate","سفارش‌ها (۹۰ روز)","cost_per_order"
+        ]), out)
+        impact[["افزایش GMV (۹۰ روز)","سهم پلتفرم از افزایش GMV","هزینه کل","خالص اثر بر پلتفرم"]] = out
 
     if ffd is None:
         # demo 7-day logs
@@ -93,10 +194,12 @@ def load_data():
         ts = pd.date_range(now - pd.Timedelta(days=6), now, freq="H")
         nodes = ["Node1_high_risk","Node2_segment_geo","Node3_stable_hold"]
         ffd = pd.DataFrame({
-            "timestamp": np.random.choice(ts, 600),
-            "node": np.random.choice(nodes, 600, p=[0.35,0.45,0.20]),
-            "guardrail_fired": np.random.choice([0,1], 600, p=[0.85,0.15])
+            "timestamp": rng.choice(ts.values, 600),
+            "node": rng.choice(nodes, 600, p=[0.35,0.45,0.20]),
+            "guardrail_fired": rng.choice([0,1], 600, p=[0.85,0.15])
         })
+    # sorted, NaT-free log so the 7-day window is a tail slice
+    ffd = ffd[ffd["timestamp"].notna()].sort_values("timestamp", kind="stable", ignore_index=True)
 
     if inc is None:
         # demo incidents
@@ -108,43 +211,84 @@ def load_data():
             "title":["Carrier outage in PR","API throttle on checkout"],
             "status":["open","open"]
         })
-    return clean, seg, impact, ffd, inc
+    # lowercased once; the open filter is then a categorical code compare
+    inc = inc.assign(status=pd.Categorical(inc["status"].str.lower()))
+
+    # Persian labels as Arrow strings: the scenario filter and segment merge run in Arrow kernels
+    seg = seg.astype({c: "string[pyarrow]" for c in seg.select_dtypes("object").columns})
+    impact = impact.astype({c: "string[pyarrow]" for c in impact.select_dtypes("object").columns})
 
-clean, seg, impact, ffd, inc = load_data()
+    # base scenario and its per-segment join are fixed for the session
+    impact_base = impact[impact["سناریو"]=="پایه"]
+    base_impact = (impact_base[["سگمنت","خالص اثر بر پلتفرم"]]
+                   .groupby("سگمنت", as_index=False).sum()
+                   .rename(columns={"خالص اثر بر پلتفرم":"اثر ۹۰ روزه (خالص/پایه)"}))
+    seg_view = seg.merge(base_impact, on="سگمنت", how="left")
+    return clean, ffd, inc, impact_base, seg_view
 
-# ---------- Time window & baseline ----------
+# derived tables: content-hashed by st.cache_data, so reruns with unchanged inputs skip the work
+@st.cache_data
+def compute_weekly(df90):
+    # Monday-start weeks, as before (numpy's datetime64[W] would bucket from Thursday)
+    week_key = df90["order_purchase_timestamp"].dt.to_period("W").dt.start_time
+    weekly = (df90
+              .groupby(week_key)
+              .agg(orders=("order_id","size"), otd=("on_time","mean"),
+                   review=("review_score_mean","mean"))
+              .reset_index())
+    weekly["otd_pct"] = weekly["otd"]*100
+    # default (Cython) engine: on a dozen weekly rows the numba engine's ~3s per-process JIT never pays off
+    weekly["review_rolling"] = weekly["review"].rolling(4, min_periods=1).mean()
+    return weekly
+
+@st.cache_data
+def compute_policy(ffd):
+    ts = ffd["timestamp"]
+    last7 = ffd.iloc[ts.searchsorted(ts.iat[-1] - pd.Timedelta(days=7)):] if len(ts) else ffd
+    # one hash pass over both keys; each table is a marginal of it
+    g = last7.groupby(["node","guardrail_fired"], observed=True, dropna=False).size()
+    node_counts = g.groupby(level="node").sum().reset_index(name="fires")
+    gr_counts = g.groupby(level="guardrail_fired").sum().reset_index(name="count")
+    gr_counts["label"] = np.array(["No","Yes"])[gr_counts["guardrail_fired"].to_numpy(dtype="int64")]
+    return node_counts, gr_counts
+
+@st.cache_resource
+def weekly_chart(weekly, y, title, tooltip):
+    # keyed on weekly's content, so the Vega-Lite spec is only rebuilt when the data changes
+    return alt.Chart(weekly).mark_line(point=True).encode(
+        x=alt.X("order_purchase_timestamp:T", title="Week"),
+        y=alt.Y(y, title=title),
+        tooltip=tooltip
+    ).properties(height=240)
+
+clean, ffd, inc, impact_base, seg_view = load_data()
+
+# ---------- Time window ----------
 end_date = clean["order_purchase_timestamp"].max()
 start_90 = end_date - pd.Timedelta(days=90)
-df90 = clean[clean["order_purchase_timestamp"].between(start_90, end_date)].copy()
-
-weekly = (df90
-          .groupby(df90["order_purchase_timestamp"].dt.to_period("W").apply(lambda r: r.start_time))
-          .agg(orders=("order_id","nunique"), otd=("on_time","mean"),
-               review=("review_score_mean","mean"))
-          .reset_index())
-weekly["otd_pct"] = weekly["otd"]*100
-weekly["review_rolling"] = weekly["review"].rolling(4, min_periods=1).mean()
+ts = clean["order_purchase_timestamp"].values
+lo = np.searchsorted(ts, start_90.to_datetime64(), side="left")
+hi = np.searchsorted(ts, end_date.to_datetime64(), side="right")
+df90 = clean.iloc[lo:hi]
 
-baseline_otd = weekly["otd_pct"].mean()
-baseline_p90 = np.nanpercentile(df90["delivery_time_days"].dropna(), 90)
+weekly = compute_weekly(df90)
 
 # ---------- KPI Cards ----------
 st.markdown("### کارت‌های KPI")
 col1, col2, col3, col4 = st.columns(4)
 
-# NSM: On-time delivered orders count (90d)
-nsm_value = int(df90[df90["on_time"]==1]["order_id"].nunique())
+# NSM: On-time delivered orders count (90d); one row per order_id, on_time is 0/1
+nsm_value = int(df90["on_time"].sum())
 col1.metric("North Star (On-time Orders, 90d)", f"{nsm_value:,}")
 
 # OTD
 col2.metric("OTD (90d)", f"{(df90['on_time'].mean()*100):.1f}%")
 
 # p90
-p90 = np.nanpercentile(df90["delivery_time_days"].dropna(), 90) if df90["delivery_time_days"].notna().any() else np.nan
+p90 = _p90(df90["delivery_time_days"].to_numpy())
 col3.metric("Delivery Time p90 (days)", f"{p90:.1f}")
 
 # Net GMV growth (base scenario)
-impact_base = impact[impact["سناریو"]=="پایه"]
 net_gain = impact_base["خالص اثر بر پلتفرم"].sum()
 col4.metric("Net GMV Growth (90d, base)", f"${net_gain:,.0f}")
 
@@ -156,37 +300,23 @@ c1, c2 = st.columns([2,1])
 
 with c1:
     st.caption("نوسان هفتگی OTD")
-    chart_otd = alt.Chart(weekly).mark_line(point=True).encode(
-        x=alt.X("order_purchase_timestamp:T", title="Week"),
-        y=alt.Y("otd_pct:Q", title="OTD (%)"),
-        tooltip=["order_purchase_timestamp","orders","otd_pct"]
-    ).properties(height=240)
+    chart_otd = weekly_chart(weekly, "otd_pct:Q", "OTD (%)", ["order_purchase_timestamp","orders","otd_pct"])
     st.altair_chart(chart_otd, use_container_width=True)
 
 with c2:
     st.caption("افت امتیاز ریویو (قناری)")
-    chart_rev = alt.Chart(weekly).mark_line(point=True).encode(
-        x=alt.X("order_purchase_timestamp:T", title="Week"),
-        y=alt.Y("review_rolling:Q", title="Review (4w rolling)"),
-        tooltip=["order_purchase_timestamp","review_rolling"]
-    ).properties(height=240)
+    chart_rev = weekly_chart(weekly, "review_rolling:Q", "Review (4w rolling)", ["order_purchase_timestamp","review_rolling"])
     st.altair_chart(chart_rev, use_container_width=True)
 
 st.caption("رویدادهای باز (incidents)")
-open_inc = inc[inc["status"].str.lower()=="open"].copy()
+open_inc = inc[inc["status"]=="open"]
 open_inc = open_inc.sort_values("opened_at", ascending=False)
-st.dataframe(open_inc, use_container_width=True, hide_index=True)
+st.dataframe(_arrow(open_inc), use_container_width=True, hide_index=True)
 
 st.divider()
 
 # ---------- Segments Table ----------
 st.markdown("### جدول سگمنت‌ها (این فصل)")
-# Join expected impact (base) per segment
-base_impact = (impact_base[["سگمنت","خالص اثر بر پلتفرم"]]
-               .groupby("سگمنت", as_index=False).sum()
-               .rename(columns={"خالص اثر بر پلتفرم":"اثر ۹۰ روزه (خالص/پایه)"}))
-seg_view = seg.merge(base_impact, on="سگمنت", how="left")
-
 seg_view = seg_view.rename(columns={
     "اندازه":"اندازه (Orders)",
     "OTD":"OTD (%)",
@@ -195,15 +325,13 @@ seg_view = seg_view.rename(columns={
     "اثر ۹۰ روزه (خالص/پایه)":"اثر ۹۰ روزهٔ مورد انتظار"
 })
 seg_cols = ["سگمنت","اندازه (Orders)","OTD (%)","Repeat (%)","اقدام برنامه‌ریزی‌شده","اثر ۹۰ روزهٔ مورد انتظار"]
-st.dataframe(seg_view[seg_cols], use_container_width=True, hide_index=True)
+st.dataframe(_arrow(seg_view[seg_cols]), use_container_width=True, hide_index=True)
 
 st.divider()
 
 # ---------- Policy Status ----------
 st.markdown("### وضعیت سیاست (FFD Policy Status – last 7 days)")
-last7 = ffd[ffd["timestamp"] >= (ffd["timestamp"].max() - pd.Timedelta(days=7))].copy()
-node_counts = last7.groupby("node")["timestamp"].count().reset_index().rename(columns={"timestamp":"fires"})
-gr_counts = last7.groupby("guardrail_fired")["timestamp"].count().reset_index().rename(columns={"timestamp":"count"})
+node_counts, gr_counts = compute_policy(ffd)
 
 cc1, cc2 = st.columns(2)
 with cc1:
@@ -211,7 +339,6 @@ with cc1:
     st.dataframe(node_counts.sort_values("fires", ascending=False), use_container_width=True, hide_index=True)
 with cc2:
     st.caption("Guardrails Tripped (7d)")
-    gr_counts["label"] = gr_counts["guardrail_fired"].map({0:"No",1:"Yes"})
     st.dataframe(gr_counts[["label","count"]], use_container_width=True, hide_index=True)
 
 st.info("راهنما: حباب بزرگ‌تر در سگمنت‌ها یعنی سهم GMV بیشتر؛ OTD بالاتر بهتر است؛ p90 پایین‌تر نشانهٔ عملیات چابک‌تر است.")